@@ -1,3 +1,5 @@
+import logging
+
 import typer
 
 from mlflux.cli.hello import hello
@@ -5,6 +7,12 @@ from mlflux.cli.run import run
 
 app = typer.Typer()
 
+
+@app.callback()
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+
 app.command()(hello)
 app.command()(run)
 
@@ -1,17 +1,30 @@
+import errno
+import functools
+import hashlib
+import logging
+import mmap
 import os
+import posixpath
+import re
 import shutil
 import sys
-import uuid
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import itemgetter
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from typing import List, Optional
+from tempfile import mkdtemp
+from typing import Callable, Iterator, List, Optional, Tuple
 
-import docker
-import mlflow
+import pathspec
 import typer
-import yaml
-from gitignore_parser import parse_gitignore
-from loguru import logger
+
+# docker, mlflow and yaml are imported where they are used so that commands not
+# needing them (and --help) don't pay for importing them
+
+logger = logging.getLogger(__name__)
 
 
 # region : copied from mlflow.cli
@@ -21,57 +34,347 @@ def eprint(*args, **kwargs):
 
 def _user_args_to_dict(arguments, argument_type="P"):
     user_dict = {}
+    setdefault = user_dict.setdefault
+    # Docker arguments such as `t` don't require a value -> set to True if specified
+    allow_flags = argument_type == "A"
     for arg in arguments:
-        split = arg.split("=", maxsplit=1)
-        # Docker arguments such as `t` don't require a value -> set to True if specified
-        if len(split) == 1 and argument_type == "A":
-            name = split[0]
+        name, sep, value = arg.partition("=")
+        if not sep:
+            if not allow_flags:
+                eprint(
+                    "Invalid format for -%s parameter: '%s'. "
+                    "Use -%s name=value." % (argument_type, arg, argument_type)
+                )
+                sys.exit(1)
             value = True
-        elif len(split) == 2:
-            name = split[0]
-            value = split[1]
-        else:
-            eprint(
-                "Invalid format for -%s parameter: '%s'. "
-                "Use -%s name=value." % (argument_type, arg, argument_type)
-            )
-            sys.exit(1)
-        if name in user_dict:
+        # one hash probe both inserts the value and detects a repeated name
+        size = len(user_dict)
+        setdefault(name, value)
+        if len(user_dict) == size:
             eprint("Repeated parameter: '%s'" % name)
             sys.exit(1)
-        user_dict[name] = value
     return user_dict
 
 
 # endregion
 
 
-def _copy_from_uri(uri: str, project_path: Path, output_path) -> Optional[Path]:
+_COPY_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+}
+
+
+# without it Windows opens the fds in text mode, and the buffered fallback
+# copy would translate line endings and stop at the first Ctrl-Z
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+def _sendfile(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+_ZERO_COPY_FUNCS = []
+if hasattr(os, "copy_file_range"):
+    _ZERO_COPY_FUNCS.append(os.copy_file_range)
+if hasattr(os, "sendfile"):
+    _ZERO_COPY_FUNCS.append(_sendfile)
+
+
+def _copy_fd(src_fd: int, dst_fd: int, size: int, count: Optional[int] = None) -> int:
+    # keep bytes in the kernel, falling back to a userspace copy only when
+    # neither copy_file_range nor sendfile support this pair of files; copies
+    # until EOF, or at most count bytes, and returns the number of bytes copied
+    blocksize = max(size, 2 ** 23)
+    copied = 0
+
+    for copy in _ZERO_COPY_FUNCS:
+        try:
+            while True:
+                n = copy(
+                    src_fd,
+                    dst_fd,
+                    blocksize if count is None else min(blocksize, count - copied),
+                )
+                if not n:
+                    return copied
+                copied += n
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    with open(src_fd, "rb", closefd=False) as fsrc, open(
+        dst_fd, "wb", closefd=False
+    ) as fdst:
+        while count is None or copied < count:
+            buf = fsrc.read(1 << 20 if count is None else min(1 << 20, count - copied))
+            if not buf:
+                break
+            fdst.write(buf)
+            copied += len(buf)
+
+    return copied
+
+
+def _copy_file(src: str, dst: str, mode: int, size: int):
+    src_fd = os.open(src, os.O_RDONLY | _O_BINARY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, mode)
+        try:
+            _copy_fd(src_fd, dst_fd, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _crc32(fd: int, size: int) -> int:
+    # one crc32 call over the mapped file instead of a Python loop over chunks;
+    # raises ValueError if the file has shrunk below size
+    if not size:
+        # empty mappings are not allowed
+        return 0
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mm:
+        return zlib.crc32(mm)
+
+
+class _ZipFile(zipfile.ZipFile):
+    # ZipFile.write pushes stored entries through a read/write loop in Python;
+    # here their data is moved with the same zero-copy path as the tree copy
+    def write(self, filename, arcname=None, compress_type=None, compresslevel=None):
+        zinfo = zipfile.ZipInfo.from_file(
+            filename, arcname, strict_timestamps=self._strict_timestamps
+        )
+        if compress_type != zipfile.ZIP_STORED or zinfo.is_dir():
+            return super().write(filename, arcname, compress_type, compresslevel)
+
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.compress_size = zinfo.file_size
+
+        src_fd = os.open(filename, os.O_RDONLY | _O_BINARY)
+        try:
+            try:
+                zinfo.CRC = _crc32(src_fd, zinfo.file_size)
+            except ValueError:
+                complete = False
+            else:
+                complete = self._write_stored(zinfo, src_fd)
+        finally:
+            os.close(src_fd)
+
+        if not complete:
+            # the file shrank after it was stat'ed; let ZipFile take size and CRC
+            # from the bytes it actually reads
+            super().write(filename, arcname, compress_type, compresslevel)
+
+    def _write_stored(self, zinfo: zipfile.ZipInfo, src_fd: int) -> bool:
+        with self._lock:
+            if self._writing:
+                raise ValueError(
+                    "Can't write to ZIP archive while an open writing handle exists"
+                )
+            self._writecheck(zinfo)
+            self._didModify = True
+
+            self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.fp.tell()
+            self.fp.write(zinfo.FileHeader())
+            self.fp.flush()
+
+            copied = _copy_fd(
+                src_fd, self.fp.fileno(), zinfo.file_size, zinfo.file_size
+            )
+            if copied != zinfo.file_size:
+                # drop the partial entry; the data bypassed the buffered file
+                # object, so seeking also resyncs its position
+                self.fp.seek(zinfo.header_offset)
+                self.fp.truncate()
+                return False
+
+            # the data bypassed the buffered file object, resync its position
+            self.start_dir = self.fp.seek(0, os.SEEK_END)
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+            return True
+
+
+# already compressed formats that DEFLATE cannot shrink any further
+_STORED_SUFFIXES = {
+    ".7z",
+    ".bz2",
+    ".gz",
+    ".jpeg",
+    ".jpg",
+    ".npz",
+    ".parquet",
+    ".png",
+    ".pt",
+    ".pth",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+
+def _compress_type(arcname: str) -> Optional[int]:
+    if posixpath.splitext(arcname)[1].lower() in _STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return None
+
+
+def _copy_files(files: List[Tuple[str, str, int, int]]):
+    for src, dst, mode, size in files:
+        _copy_file(src, dst, mode, size)
+
+
+def _copy_workers() -> int:
+    # e.g. MLFLUX_COPY_WORKERS=2 when source and temp dir share a spinning disk
+    workers = os.environ.get("MLFLUX_COPY_WORKERS")
+    if workers is None:
+        return min(32, (os.cpu_count() or 1) * 4)
+
+    try:
+        return max(1, int(workers))
+    except ValueError:
+        eprint("Invalid value for MLFLUX_COPY_WORKERS: '%s'. Use an integer." % workers)
+        sys.exit(1)
+
+
+_COPY_BATCH_SIZE = 1000
+
+
+def _gitignore_matcher(gitignore_path: Path) -> Callable[[str], bool]:
+    with gitignore_path.open() as f:
+        spec = pathspec.PathSpec.from_lines("gitwildmatch", f)
+
+    patterns = [p for p in spec.patterns if p.include is not None]
+    if not patterns:
+        return lambda path: False
+
+    if all(p.include for p in patterns):
+        # without negations "last matching pattern wins" reduces to "any pattern
+        # matches", so the whole file can be evaluated as a single regex
+        regex = re.compile("|".join(p.regex.pattern for p in patterns))
+        return lambda path: regex.match(path) is not None
+
+    return spec.match_file
+
+
+def _is_ignored(ignored: Callable[[str], bool], rel: str, is_dir: bool) -> bool:
+    # rel is relative to the source root; directories are matched both bare, for
+    # patterns like "data/*", and with a trailing slash, for "build/"
+    return ignored(rel) or (is_dir and ignored(rel + "/"))
+
+
+def _walk_tree(
+    src: str, dst: str, ignored: Optional[Callable[[str], bool]], arcdir: str = ""
+) -> Iterator[Tuple[str, str, str, Optional[os.stat_result]]]:
+    # directories are created as they are visited, parents before children
+    os.makedirs(dst, exist_ok=True)
+
+    with os.scandir(src) as it:
+        entries = list(it)
+
+    if ignored is not None:
+        entries = [
+            e
+            for e in entries
+            if e.name != ".git"
+            and not _is_ignored(ignored, posixpath.join(arcdir, e.name), e.is_dir())
+        ]
+
+    for entry in entries:
+        dst_entry = os.path.join(dst, entry.name)
+        arcname = posixpath.join(arcdir, entry.name)
+        if entry.is_dir():
+            yield entry.path, dst_entry, arcname, None
+            yield from _walk_tree(entry.path, dst_entry, ignored, arcname)
+        elif entry.is_file():
+            yield entry.path, dst_entry, arcname, entry.stat()
+        else:
+            # opening e.g. a FIFO would block forever; fail fast like copytree did
+            raise shutil.SpecialFileError(
+                f"`{entry.path}` is not a regular file or directory"
+            )
+
+
+def _copy_from_uri(
+    uri: str, project_path: Path, output_path: Path
+) -> Tuple[Path, bytes]:
     # TODO: git uri
-    src_path = Path(uri)
+    src_path = Path(uri).resolve()
 
     gitignore_path = src_path / ".gitignore"
-    if gitignore_path.exists():
-        matches = parse_gitignore(gitignore_path.as_posix())
+    ignored = _gitignore_matcher(gitignore_path) if gitignore_path.exists() else None
+
+    entries = list(_walk_tree(src_path.as_posix(), project_path.as_posix(), ignored))
+    files = [
+        (src, dst, st.st_mode & 0o777, st.st_size)
+        for src, dst, _, st in entries
+        if st is not None
+    ]
+
+    workers = _copy_workers()
+    batch_size = max(1, min(_COPY_BATCH_SIZE, -(-len(files) // workers)))
+
+    src_zip = output_path / "src.zip"
+    with ThreadPoolExecutor(max_workers=workers) as executor, _ZipFile(
+        src_zip, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1
+    ) as zf:
+        copies = [
+            executor.submit(_copy_files, files[i : i + batch_size])
+            for i in range(0, len(files), batch_size)
+        ]
+
+        for src, _, arcname, _ in entries:
+            zf.write(src, arcname, compress_type=_compress_type(arcname))
+
+        for copy in copies:
+            copy.result()
+
+    # identifies the build context from file metadata of the source tree,
+    # whose mtimes (unlike those of the fresh copy) are stable across runs;
+    # the mode is included because chmod leaves mtime untouched
+    context = hashlib.blake2b(digest_size=12)
+    for _, _, arcname, st in sorted(entries, key=itemgetter(2)):
+        if st is not None:
+            context.update(
+                f"{arcname}\0{st.st_mode}\0{st.st_mtime_ns}\0{st.st_size}\0".encode()
+            )
+
+    return src_zip, context.digest()
+
 
-        def ignore(src, names):
-            return [f for f in names if matches(os.path.join(src, f)) or (f == ".git")]
+def _load_ml_project(project_path: Path) -> dict:
+    import yaml
 
-    else:
-        ignore = None
+    # the libyaml-backed classes only exist when PyYAML was built against it
+    with (project_path / "MLproject").open() as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
-    shutil.copytree(src_path, project_path, ignore=ignore, dirs_exist_ok=True)
 
-    src_zip = Path(shutil.make_archive(output_path / "src", "zip", project_path))
+def _dump_ml_project(project_path: Path, ml_project: dict):
+    import yaml
 
-    return src_zip
+    with (project_path / "MLproject").open("w") as f:
+        yaml.dump(ml_project, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
 
 
-def _setup_docker_image(project_path: Path, output_path: Path) -> Optional[Path]:
-    ml_project_path = project_path / "MLproject"
+@functools.lru_cache(maxsize=1)
+def _docker_client():
+    # from_env negotiates the API version with the daemon, so do it once
+    import docker
 
-    with ml_project_path.open() as f:
-        ml_project = yaml.safe_load(f)
+    return docker.from_env()
+
+
+def _setup_docker_image(
+    project_path: Path, ml_project: dict, context_digest: bytes, output_path: Path
+) -> Optional[Path]:
+    import docker
 
     tag = ml_project["docker_env"]["image"]
     try:
@@ -80,10 +383,22 @@ def _setup_docker_image(project_path: Path, output_path: Path) -> Optional[Path]
         dockerfile = project_path / "Dockerfile"
 
     if (":" not in tag) and dockerfile.exists():
-        tag += f":{uuid.uuid4()}"
+        context = hashlib.blake2b(context_digest, digest_size=8)
+        context.update(dockerfile.read_bytes())
+        tag += f":{context.hexdigest()}"
+
+        ml_project["docker_env"]["image"] = tag
+
+        docker_client = _docker_client()
+        try:
+            docker_client.images.get(tag)
+        except docker.errors.ImageNotFound:
+            pass
+        else:
+            logger.info(f"Docker image {tag} already built")
+            return None
 
         logger.info(f"Building docker image {tag} from {dockerfile}")
-        docker_client = docker.from_env()
         img, docker_logs = docker_client.images.build(
             path=project_path.as_posix(),
             dockerfile=dockerfile.relative_to(project_path).as_posix(),
@@ -91,27 +406,17 @@ def _setup_docker_image(project_path: Path, output_path: Path) -> Optional[Path]
         )
         logger.info(f"Docker image {tag} built")
 
-        ml_project["docker_env"]["image"] = tag
-        with ml_project_path.open("w") as f:
-            yaml.safe_dump(ml_project, f)
-
         docker_logs_path = output_path / "docker.stdout.txt"
-        with docker_logs_path.open("w") as f:
+        with docker_logs_path.open("w", buffering=1 << 20) as f:
             for log in docker_logs:
-                try:
-                    f.write(log["stream"])
-                except KeyError:
-                    pass
+                stream = log.get("stream")
+                if stream:
+                    f.write(stream)
 
         return docker_logs_path
 
 
-def _setup_entrypoint_output(project_path, entry_point, output_path):
-    ml_project_path = project_path / "MLproject"
-
-    with ml_project_path.open() as f:
-        ml_project = yaml.safe_load(f)
-
+def _setup_entrypoint_output(project_path, ml_project, entry_point, output_path):
     volumes = ml_project["docker_env"].get("volumes", [])
     volumes.append(f"{output_path.as_posix()}:/output")
     ml_project["docker_env"]["volumes"] = volumes
@@ -122,45 +427,74 @@ def _setup_entrypoint_output(project_path, entry_point, output_path):
     command = ml_project["entry_points"][entry_point]["command"]
     wrapper = project_path / "wrapper.sh"
     wrapper.write_text(
-        f"{command} $@ 1> >(tee /output/stdout.txt) 2> >(tee /output/stderr.txt >&2)"
+        f'{command} "$@" 1> >(tee /output/stdout.txt) 2> >(tee /output/stderr.txt >&2)'
     )
     ml_project["entry_points"][entry_point]["command"] = f"bash wrapper.sh"
 
-    with ml_project_path.open("w") as f:
-        yaml.safe_dump(ml_project, f)
-
     return stdout, stderr
 
 
+@contextmanager
+def _temporary_directory() -> Iterator[str]:
+    # like TemporaryDirectory, but the tree is removed on a background thread so
+    # that it overlaps with whatever runs next; being non-daemon, the thread
+    # still finishes before the interpreter exits
+    path = mkdtemp()
+    try:
+        yield path
+    finally:
+        threading.Thread(
+            target=shutil.rmtree, args=(path,), kwargs={"ignore_errors": True}
+        ).start()
+
+
 def run(
     *,
     param_list: List[str] = typer.Option([], "-P", "--param-list"),
     entry_point: str = typer.Option("main", "-e", "--entry-point"),
     uri: str,
 ):
+    import mlflow
+
     params_dict = _user_args_to_dict(param_list)
 
-    with TemporaryDirectory() as project_dir, TemporaryDirectory() as output_dir:
-        project_path = Path(project_dir)
+    with _temporary_directory() as output_dir:
         output_path = Path(output_dir)
 
-        src = _copy_from_uri(uri, project_path, output_path)
-        docker_logs = _setup_docker_image(project_path, output_path)
+        with _temporary_directory() as project_dir:
+            project_path = Path(project_dir)
 
-        stdout, stderr = _setup_entrypoint_output(
-            project_path, entry_point, output_path
-        )
+            # mlflow.projects.run only accepts a project directory, and MLproject
+            # and wrapper.sh are rewritten in it, so the tree has to exist on disk;
+            # the src.zip artifact is produced in the same pass over the source
+            src, context_digest = _copy_from_uri(uri, project_path, output_path)
+            ml_project = _load_ml_project(project_path)
+            docker_logs = _setup_docker_image(
+                project_path, ml_project, context_digest, output_path
+            )
 
-        mlflow_run = mlflow.projects.run(
-            uri=project_path.as_posix(),
-            entry_point=entry_point,
-            parameters=params_dict,
-        )
+            stdout, stderr = _setup_entrypoint_output(
+                project_path, ml_project, entry_point, output_path
+            )
+            _dump_ml_project(project_path, ml_project)
+
+            mlflow_run = mlflow.projects.run(
+                uri=project_path.as_posix(),
+                entry_point=entry_point,
+                parameters=params_dict,
+            )
+
+        # stage everything so it is uploaded in a single log_artifacts call
+        artifacts_path = output_path / "_artifacts"
+        logs_path = artifacts_path / "logs"
+        logs_path.mkdir(parents=True)
+
+        src.replace(artifacts_path / src.name)
+        for log in (docker_logs, stdout, stderr):
+            if log is not None:
+                log.replace(logs_path / log.name)
 
         with mlflow.start_run(mlflow_run.run_id):
-            mlflow.log_artifact(src.as_posix())
-            mlflow.log_artifact(docker_logs.as_posix(), "logs")
-            mlflow.log_artifact(stdout.as_posix(), "logs")
-            mlflow.log_artifact(stderr.as_posix(), "logs")
+            mlflow.log_artifacts(artifacts_path.as_posix())
             # TODO: set version
             # TODO: set source
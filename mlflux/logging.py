@@ -5,11 +5,14 @@ import mlflow
 
 
 def log_input_params(f):
+    default_params = {
+        k: v.default
+        for k, v in inspect.signature(f).parameters.items()
+        if v.default is not inspect.Parameter.empty
+    }
+
     @functools.wraps(f)
     def wrapper(**kwargs):
-        default_params = {
-            k: v.default for k, v in inspect.signature(f).parameters.items()
-        }
         params = {**default_params, **kwargs}
         mlflow.log_params(params)
 
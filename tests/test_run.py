@@ -0,0 +1,121 @@
+import importlib
+import os
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from mlflux.cli.run import _copy_from_uri, _gitignore_matcher, _walk_tree
+
+# mlflux.cli re-exports the run command under the module's name
+run = importlib.import_module("mlflux.cli.run")
+
+
+def _make_tree(root: Path, gitignore: str, files):
+    root.mkdir()
+    (root / ".gitignore").write_text(gitignore)
+    for name in files:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+
+
+def _walked_files(src: Path, dst: Path):
+    ignored = _gitignore_matcher(src / ".gitignore")
+    return sorted(
+        arcname
+        for _, _, arcname, st in _walk_tree(src.as_posix(), dst.as_posix(), ignored)
+        if st is not None
+    )
+
+
+def test_walk_tree_gitignore_dir_patterns(tmp_path):
+    src = tmp_path / "src"
+    _make_tree(
+        src,
+        "build/\ndata/*\n!data/.gitkeep\nlogs/*\n",
+        [
+            "main.py",
+            "build/lib/out.py",
+            "data/.gitkeep",
+            "data/raw/big.csv",
+            "logs/run1/events.out",
+            "pkg/build/x.py",
+        ],
+    )
+
+    assert _walked_files(src, tmp_path / "dst") == [
+        ".gitignore",
+        "data/.gitkeep",
+        "main.py",
+    ]
+    assert not (tmp_path / "dst" / "data" / "raw").exists()
+
+
+@pytest.mark.parametrize(
+    "gitignore, expected",
+    [
+        # no negations: evaluated as a single compiled regex
+        ("build/\ndata/*\n", [".gitignore", "main.py"]),
+        # negations: evaluated by PathSpec.match_file
+        (
+            "build/\ndata/*\n!data/.gitkeep\n",
+            [".gitignore", "data/.gitkeep", "main.py"],
+        ),
+    ],
+)
+def test_gitignore_matcher_branches(tmp_path, gitignore, expected):
+    src = tmp_path / "src"
+    _make_tree(
+        src,
+        gitignore,
+        ["main.py", "build/out.py", "data/.gitkeep", "data/raw/big.csv"],
+    )
+
+    assert _walked_files(src, tmp_path / "dst") == expected
+
+
+def test_copy_from_uri_context_digest_tracks_mode(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    entrypoint = src / "entrypoint.sh"
+    entrypoint.write_text("echo hi\n")
+    entrypoint.chmod(0o644)
+
+    def digest(name):
+        output_path = tmp_path / name
+        output_path.mkdir()
+        return _copy_from_uri(src.as_posix(), output_path / "project", output_path)[1]
+
+    before = digest("first")
+    assert digest("second") == before
+
+    entrypoint.chmod(0o755)
+    assert digest("third") != before
+
+
+@pytest.mark.parametrize("truncate_before_crc", [False, True])
+def test_zipfile_stored_entry_survives_shrinking_file(
+    tmp_path, monkeypatch, truncate_before_crc
+):
+    weights = tmp_path / "weights.pt"
+    weights.write_bytes(os.urandom(100_000))
+    crc32 = run._crc32
+
+    def shrinking_crc32(fd, size):
+        if truncate_before_crc:
+            os.truncate(weights, 40_000)
+        crc = crc32(fd, size)
+        os.truncate(weights, 40_000)
+        return crc
+
+    monkeypatch.setattr(run, "_crc32", shrinking_crc32)
+
+    with run._ZipFile(tmp_path / "src.zip", "w") as zf:
+        zf.write(weights, "weights.pt", compress_type=zipfile.ZIP_STORED)
+        zf.write(weights, "again.pt", compress_type=zipfile.ZIP_STORED)
+
+    with zipfile.ZipFile(tmp_path / "src.zip") as zf:
+        assert zf.testzip() is None
+        assert zf.read("weights.pt") == weights.read_bytes()
+        assert zf.read("again.pt") == weights.read_bytes()